@@ -0,0 +1,345 @@
+"""NLSystemの最寄りノード検索をUnixドメインソケット/TCPで提供するサーバとクライアント。
+
+1プロセスでNLSystemを保持し、複数のクライアントからのバッチ問い合わせに並行して応答する。
+
+フレーム形式(ビッグエンディアン):
+    ヘッダ: uint32 本体長, uint32 リクエストID, uint8 オペコード(応答ではステータス)
+    OP_QUERY 本体: float64 radius(NaNでサーバ既定値), 続いて (float64 lat, float64 lon) の繰り返し
+    OP_RELOAD 本体: なし
+    応答本体(STATUS_OK, OP_QUERY): 問い合わせ順に
+        float64 dist, float64 lat, float64 lon, uint16 名前長, 名前(UTF-8)
+        該当ノードなしの場合は名前長が0xFFFFで名前は続かない
+    応答本体(STATUS_ERROR): エラーメッセージ(UTF-8)
+
+ノード名はstr()で文字列化して送るため、クライアントが受け取る名前は常にstrになる。
+
+応答は処理が終わった順に返るため、クライアントはリクエストIDで対応付ける(パイプライン可)。
+
+起動例:
+    python -m VelLib.nl_server --pickle nodes.pkl --unix /tmp/nl.sock
+    python -m VelLib.nl_server --loader mymodule:build_nls --host 127.0.0.1 --port 7878 --reload-interval 600
+"""
+import argparse
+import asyncio
+import importlib
+import math
+import os
+import pickle
+import signal
+import socket
+import stat
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import get_logger
+
+HEADER = struct.Struct("!IIB")
+RADIUS = struct.Struct("!d")
+COORD = struct.Struct("!dd")
+RESULT = struct.Struct("!dddH")
+
+OP_QUERY = 1
+OP_RELOAD = 2
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+NO_NAME = 0xFFFF
+MAX_FRAME = 64 * 1024 * 1024
+
+
+def encodeQuery(reqid, coords, radius=None):
+    """問い合わせフレームを生成する
+
+    Args:
+        reqid (int): リクエストID
+        coords (iterable): (lat, lon)のリスト
+        radius (float, optional): 探索半径(m)。Noneの場合はサーバ既定値
+
+    Returns:
+        bytes: 送信するフレーム
+    """
+    body = bytearray(RADIUS.pack(math.nan if radius is None else radius))
+    for lat, lon in coords:
+        body += COORD.pack(lat, lon)
+    return HEADER.pack(len(body), reqid, OP_QUERY) + body
+
+
+def encodeResults(results):
+    body = bytearray()
+    for res in results:
+        if res["name"] is None:
+            body += RESULT.pack(res["dist"], math.nan, math.nan, NO_NAME)
+        else:
+            name = str(res["name"]).encode("utf-8")
+            if len(name) >= NO_NAME:
+                raise ValueError("node name too long: %r" % res["name"])
+            body += RESULT.pack(res["dist"], res["lat"], res["lon"], len(name)) + name
+    return bytes(body)
+
+
+def decodeResults(body):
+    """応答本体をnearestNodeSearchと同じキーを持つdictのリストに変換する。nameは常にstr(該当なしはNone)"""
+    results = []
+    offset = 0
+    while offset < len(body):
+        dist, lat, lon, size = RESULT.unpack_from(body, offset)
+        offset += RESULT.size
+        if size == NO_NAME:
+            results.append({"name": None, "dist": dist, "lat": None, "lon": None})
+            continue
+        name = body[offset:offset+size].decode("utf-8")
+        offset += size
+        results.append({"name": name, "dist": dist, "lat": lat, "lon": lon})
+    return results
+
+
+def loadPickle(path):
+    """pickle化されたNLSystemを読み込むローダーを返す"""
+    def loader():
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    return loader
+
+
+def loadCallable(spec):
+    """"module:function"形式の指定からローダーを返す"""
+    modname, _, funcname = spec.partition(":")
+    if not funcname:
+        raise ValueError("loader must be given as module:function")
+    return getattr(importlib.import_module(modname), funcname)
+
+
+class NLServer:
+    def __init__(self, loader, workers=None, pipeline=64, reloadInterval=None):
+        """
+        Args:
+            loader (callable): NLSystemを生成して返す関数。起動時と再読み込み時に呼ばれる
+            workers (int, optional): 検索を行うスレッド数
+            pipeline (int): 1接続あたり同時に処理するリクエスト数の上限
+            reloadInterval (float, optional): 定期的に再読み込みする間隔(秒)
+        """
+        self.loader = loader
+        self.pipeline = pipeline
+        self.reloadInterval = reloadInterval
+        self.executor = ThreadPoolExecutor(workers)
+        self.nls = loader()
+        self._reloading = None
+        self._autoReloadTask = None
+        self._logger = get_logger()
+
+    def search(self, nls, radius, body):
+        results = []
+        for lat, lon in COORD.iter_unpack(body):
+            results.append(nls.nearestNodeSearch(lat, lon, radius))
+        return encodeResults(results)
+
+    def reload(self):
+        """バックグラウンドでNLSystemを読み込み直す。読み込みが終わるまでは既存のものを使い続ける。
+
+        Returns:
+            asyncio.Task: 再読み込みのタスク(実行中の場合はそのタスク)
+        """
+        if self._reloading is None or self._reloading.done():
+            self._reloading = asyncio.ensure_future(self._reload())
+        return self._reloading
+
+    async def _reload(self):
+        loop = asyncio.get_event_loop()
+        try:
+            nls = await loop.run_in_executor(None, self.loader)
+        except Exception as e:
+            self._logger.warning("%s reload failed: %s" % (self.__class__, e))
+            return False
+        self.nls = nls
+        self._logger.info("%s reloaded %d nodes", self.__class__, len(nls.nodes))
+        return True
+
+    async def _autoReload(self):
+        while True:
+            await asyncio.sleep(self.reloadInterval)
+            await asyncio.shield(self.reload())
+
+    async def _respond(self, writer, reqid, op, body, limit):
+        loop = asyncio.get_event_loop()
+        try:
+            if op == OP_QUERY:
+                if len(body) < RADIUS.size or (len(body) - RADIUS.size) % COORD.size:
+                    raise ValueError("malformed query body")
+                radius = RADIUS.unpack_from(body)[0]
+                radius = None if math.isnan(radius) else radius
+                payload = await loop.run_in_executor(self.executor, self.search, self.nls, radius, body[RADIUS.size:])
+            elif op == OP_RELOAD:
+                # 接続が切れて_respondがキャンセルされても共有の再読み込みは止めない
+                if not await asyncio.shield(self.reload()):
+                    raise RuntimeError("reload failed")
+                payload = b""
+            else:
+                raise ValueError("unknown op: %d" % op)
+            status = STATUS_OK
+        except Exception as e:
+            status = STATUS_ERROR
+            payload = str(e).encode("utf-8")
+        finally:
+            limit.release()
+        if not writer.is_closing():
+            writer.write(HEADER.pack(len(payload), reqid, status) + payload)
+
+    async def handle(self, reader, writer):
+        limit = asyncio.Semaphore(self.pipeline)
+        tasks = set()
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+                size, reqid, op = HEADER.unpack(header)
+                if size > MAX_FRAME:
+                    self._logger.warning("%s frame too large (%d bytes), closing connection" % (self.__class__, size))
+                    break
+                body = await reader.readexactly(size)
+                await limit.acquire()
+                task = asyncio.ensure_future(self._respond(writer, reqid, op, body, limit))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                await writer.drain()
+            if tasks:
+                await asyncio.gather(*tasks)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for task in list(tasks):
+                task.cancel()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def serve(self, unix=None, host="127.0.0.1", port=7878, ready=None):
+        """サーバを起動し、停止されるまで待ち受ける
+
+        Args:
+            unix (str, optional): Unixドメインソケットのパス。指定した場合はTCPは使わない
+            host (str): TCPの待ち受けアドレス
+            port (int): TCPの待ち受けポート
+            ready (callable, optional): 待ち受け開始後に呼ばれる関数
+        """
+        loop = asyncio.get_event_loop()
+        if unix is not None:
+            if os.path.exists(unix) and stat.S_ISSOCK(os.stat(unix).st_mode):
+                os.unlink(unix)
+            server = await asyncio.start_unix_server(self.handle, path=unix)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        if hasattr(signal, "SIGHUP"):
+            try:
+                loop.add_signal_handler(signal.SIGHUP, self.reload)
+            except (NotImplementedError, RuntimeError):
+                pass
+        if self.reloadInterval:
+            self._autoReloadTask = asyncio.ensure_future(self._autoReload())
+        if ready is not None:
+            ready()
+        self._logger.info("%s listening on %s", self.__class__, unix or "%s:%d" % (host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if self._autoReloadTask is not None:
+                self._autoReloadTask.cancel()
+                self._autoReloadTask = None
+
+
+class NLClient:
+    def __init__(self, unix=None, host="127.0.0.1", port=7878):
+        """NLServerへの同期クライアント
+
+        Args:
+            unix (str, optional): Unixドメインソケットのパス。指定した場合はTCPは使わない
+            host (str): TCPの接続先アドレス
+            port (int): TCPの接続先ポート
+        """
+        if unix is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(unix)
+        else:
+            self.sock = socket.create_connection((host, port))
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile("rb")
+        self._reqid = 0
+
+    def _nextId(self):
+        self._reqid = (self._reqid + 1) & 0xFFFFFFFF
+        return self._reqid
+
+    def submit(self, coords, radius=None):
+        """問い合わせを送信し、応答を待たずにリクエストIDを返す"""
+        reqid = self._nextId()
+        self.sock.sendall(encodeQuery(reqid, coords, radius))
+        return reqid
+
+    def receive(self):
+        """応答を1つ受信する
+
+        Returns:
+            tuple: (リクエストID, 結果のリスト)
+        """
+        header = self.rfile.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ConnectionError("connection closed by server")
+        size, reqid, status = HEADER.unpack(header)
+        body = self.rfile.read(size)
+        if status != STATUS_OK:
+            raise RuntimeError(body.decode("utf-8"))
+        return reqid, decodeResults(body)
+
+    def query(self, coords, radius=None):
+        """問い合わせを送信し、結果を待って返す。未受信の応答がない状態で使う"""
+        reqid = self.submit(coords, radius)
+        while True:
+            rid, results = self.receive()
+            if rid == reqid:
+                return results
+
+    def reload(self):
+        """サーバにNLSystemの再読み込みを要求し、完了を待つ"""
+        reqid = self._nextId()
+        self.sock.sendall(HEADER.pack(0, reqid, OP_RELOAD))
+        while self.receive()[0] != reqid:
+            pass
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="NLSystem nearest node server")
+    src = parser.add_mutually_exclusive_group(required=True)
+    src.add_argument("--pickle", help="pickle化されたNLSystemのパス")
+    src.add_argument("--loader", help="NLSystemを返す関数(module:function)")
+    parser.add_argument("--unix", help="Unixドメインソケットのパス")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7878)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--pipeline", type=int, default=64)
+    parser.add_argument("--reload-interval", type=float, default=None)
+    args = parser.parse_args(argv)
+    loader = loadPickle(args.pickle) if args.pickle else loadCallable(args.loader)
+    server = NLServer(loader, workers=args.workers, pipeline=args.pipeline, reloadInterval=args.reload_interval)
+    try:
+        asyncio.run(server.serve(unix=args.unix, host=args.host, port=args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
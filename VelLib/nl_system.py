@@ -1,20 +1,59 @@
 import math
 from functools import lru_cache
 
+EARTH_RADIUS = 6371 * 1000
+MAX_LAT = math.degrees(math.atan(math.sinh(math.pi)))
+# radius以外の半径で問い合わせた場合にキャッシュするrowWindowの上限
+OTHER_WINDOW_MAX = 4096
+
 class NLSystem:
-    def __init__(self, zlv:int = 18, area:int= 1):
+    def __init__(self, zlv:int = 18, area:int= 1, radius:float = None):
+        """
+        Args:
+            zlv (int): タイルのズームレベル
+            area (int): radius未指定時に探索する周囲のタイル数
+            radius (float, optional): 探索半径(m)。指定した場合は緯度に応じて探索範囲を決定する
+        """
         self.sq = 2**zlv
         self.z = zlv
         self.nodes = {}
         self.nlmap = {}
         self.amin = abs(area)*-1
         self.amax = abs(area)+1
+        self.radius = radius
+        self._rowWindow = {}
+        self._otherWindow = {}
+
+    def __setstate__(self, state):
+        # radius導入前にpickle化されたインスタンスにも既定値を補う
+        state.setdefault("radius", None)
+        state.setdefault("_rowWindow", {})
+        state.setdefault("_otherWindow", {})
+        self.__dict__.update(state)
+        self._rebucket()
+
+    def _rebucket(self):
+        """旧deg2numで範囲外(x == 2**z, 極付近のy < 0, y >= 2**z)に登録されたノードを登録し直す"""
+        n = self.sq
+        stray = []
+        for x, col in list(self.nlmap.items()):
+            for y in [y for y in col if not (0 <= x < n and 0 <= y < n)]:
+                stray.extend(col.pop(y))
+            if not col:
+                del self.nlmap[x]
+        for key in stray:
+            lat, lon = self.nodes[key]
+            x, y = self.deg2num(lat, lon)
+            self.nlmap.setdefault(x, {}).setdefault(y, set()).add(key)
 
     def deg2num(self, lat, lon):
         lat, lon = self.valueCheck(lat, lon)
+        lat = min(max(lat, -MAX_LAT), MAX_LAT)
         lat_rad = math.radians(lat)
         n = self.sq
-        return int((lon + 180.0) / 360.0 * n), int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
+        x = int(math.floor((lon + 180.0) / 360.0 * n)) % n
+        y = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
+        return x, min(max(y, 0), n - 1)
 
     def num2deg(self, xtile, ytile):
         lon_deg = xtile / self.sq * 360.0 - 180.0
@@ -37,8 +76,7 @@ class NLSystem:
         dlat = lat2 - lat1
         a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
         c = 2 * math.asin(math.sqrt(a))
-        r = 6371
-        return c * r * 1000
+        return c * EARTH_RADIUS
 
     def register(self, lat, lon, key):
         #self.nearestNodeSearch.cache_clear()
@@ -50,26 +88,111 @@ class NLSystem:
         self.nlmap[x][y].add(key)
         self.nodes[key] = (lat, lon)
 
-    def getNodes(self, lat, lon):
+    def rowWindow(self, y, radius):
+        """タイル行yに含まれる任意の地点から半径radius(m)以内を覆うタイル範囲を返す。
+           行ごとに一度だけ計算し、以降はキャッシュを返す。
+           インスタンスのradius以外の半径はOTHER_WINDOW_MAX件まで保持し、超えたら破棄する。
+
+        Args:
+            y (int): タイル行
+            radius (float): 探索半径(m)
+
+        Returns:
+            tuple: (ymin, ymax, xhalf) xhalfがNoneの場合は全経度が対象
+        """
+        key = (y, radius)
+        cache = self._rowWindow if radius == self.radius else self._otherWindow
+        window = cache.get(key)
+        if window is not None:
+            return window
+        # 端の行はMAX_LATを超える緯度の地点も含むため極まで広げる
+        north = 90.0 if y == 0 else self.num2deg(0, y)[0]
+        south = -90.0 if y == self.sq - 1 else self.num2deg(0, y+1)[0]
+        dlat = math.degrees(radius / EARTH_RADIUS)
+        ymin = self.deg2num(north + dlat, 0)[1]
+        ymax = self.deg2num(south - dlat, 0)[1]
+        edge = max(abs(north), abs(south))
+        if dlat >= 90.0 or edge + dlat >= 90.0:
+            xhalf = None
+        else:
+            ratio = math.sin(math.radians(dlat)) / math.cos(math.radians(edge))
+            if ratio >= 1.0:
+                xhalf = None
+            else:
+                dlon = math.degrees(math.asin(ratio))
+                xhalf = math.ceil(dlon / 360.0 * self.sq)
+                if 2 * xhalf + 1 >= self.sq:
+                    xhalf = None
+        window = (ymin, ymax, xhalf)
+        if cache is self._otherWindow and len(cache) >= OTHER_WINDOW_MAX:
+            cache.clear()
+        cache[key] = window
+        return window
+
+    def precomputeRows(self, radius=None):
+        """全タイル行のrowWindowを事前に計算する。radiusを使う探索でのみ有効。
+
+        Args:
+            radius (float, optional): 探索半径(m)。省略時はインスタンスのradius
+        """
+        radius = self.radius if radius is None else radius
+        if radius is None:
+            raise ValueError("precomputeRows requires a radius (set NLSystem.radius or pass one).")
+        for y in range(self.sq):
+            self.rowWindow(y, radius)
+
+    def _collect(self, xs, ymin, ymax):
         resultset = set()
-        x, y = self.deg2num(lat, lon)
-        for i in range(self.amin, self.amax):
-            for j in range(self.amin, self.amax):
-                try:
-                    resultset.update(self.nlmap[x+i][y+j])
-                except KeyError:
-                    pass
+        if len(xs) > len(self.nlmap):
+            xs = [x for x in self.nlmap if x in xs]
+        for x in xs:
+            col = self.nlmap.get(x)
+            if col is None:
+                continue
+            if ymax - ymin + 1 > len(col):
+                for y, keys in col.items():
+                    if ymin <= y <= ymax:
+                        resultset.update(keys)
+            else:
+                for y in range(ymin, ymax+1):
+                    keys = col.get(y)
+                    if keys is not None:
+                        resultset.update(keys)
         return resultset
 
+    def getNodes(self, lat, lon, radius=None):
+        radius = self.radius if radius is None else radius
+        x, y = self.deg2num(lat, lon)
+        n = self.sq
+        if radius is None:
+            ymin = max(y + self.amin, 0)
+            ymax = min(y + self.amax - 1, n - 1)
+            xhalf = self.amax - 1
+            if 2 * xhalf + 1 >= n:
+                xhalf = None
+        else:
+            ymin, ymax, xhalf = self.rowWindow(y, radius)
+        if xhalf is None:
+            xs = range(n)
+        else:
+            xs = {(x+i) % n for i in range(-xhalf, xhalf+1)}
+        return self._collect(xs, ymin, ymax)
+
     #@lru_cache(maxsize=8192)
-    def nearestNodeSearch(self, lat, lon):
+    def nearestNodeSearch(self, lat, lon, radius=None):
+        """最寄りのノードを探索する。radiusを指定した場合(またはインスタンスに設定済みの場合)は
+           半径radius(m)以内で最寄りのノードを返し、該当がなければnameはNoneとなる。
+        """
+        radius = self.radius if radius is None else radius
         min_nodename = None
         min_dist = math.inf
         min_lat = None
         min_lon = None
-        for node in self.getNodes(lat, lon):
+        for node in self.getNodes(lat, lon, radius):
             nlat, nlon = self.nodes[node]
             dist = self.calculateDistance(lat, lon, nlat, nlon)
+            if radius is not None and dist > radius:
+                continue
             if dist < min_dist:
                 min_dist = dist
                 min_nodename = node
@@ -0,0 +1,140 @@
+"""NLServerの負荷試験。localhost上でサーバを起動し、複数のクライアントプロセスから問い合わせる。
+
+実行例:
+    python benchmarks/nl_server_bench.py --nodes 100000 --clients 4 --batch 64 --depth 8 --duration 10
+    python benchmarks/nl_server_bench.py --tcp
+"""
+import argparse
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from VelLib.nl_system import NLSystem
+from VelLib.nl_server import NLClient
+
+# 東京周辺
+LAT_RANGE = (35.5, 35.9)
+LON_RANGE = (139.5, 139.9)
+
+
+def randomCoord(rnd):
+    return rnd.uniform(*LAT_RANGE), rnd.uniform(*LON_RANGE)
+
+
+def buildIndex(path, nodes, zlv, radius):
+    rnd = random.Random(0)
+    nls = NLSystem(zlv, radius=radius)
+    for i in range(nodes):
+        lat, lon = randomCoord(rnd)
+        nls.register(lat, lon, "node%d" % i)
+    with open(path, "wb") as f:
+        pickle.dump(nls, f)
+
+
+def connect(address):
+    if isinstance(address, str):
+        return NLClient(unix=address)
+    return NLClient(host=address[0], port=address[1])
+
+
+def waitServer(address, proc, timeout=60):
+    limit = time.time() + timeout
+    while time.time() < limit:
+        if proc.poll() is not None:
+            raise RuntimeError("server exited with code %d" % proc.returncode)
+        try:
+            connect(address).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start within %d seconds" % timeout)
+
+
+def client(address, seed, batch, depth, duration, queue):
+    rnd = random.Random(seed)
+    latencies = []
+    queries = 0
+    sent = {}
+    with connect(address) as cli:
+        end = time.perf_counter() + duration
+        while True:
+            now = time.perf_counter()
+            if now >= end and not sent:
+                break
+            while len(sent) < depth and now < end:
+                coords = [randomCoord(rnd) for _ in range(batch)]
+                now = time.perf_counter()
+                sent[cli.submit(coords)] = now
+            reqid, results = cli.receive()
+            latencies.append(time.perf_counter() - sent.pop(reqid))
+            queries += len(results)
+    queue.put((queries, latencies))
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NLServer load generator (localhost)")
+    parser.add_argument("--nodes", type=int, default=100000)
+    parser.add_argument("--zlv", type=int, default=18)
+    parser.add_argument("--radius", type=float, default=500.0)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=64)
+    parser.add_argument("--depth", type=int, default=8, help="1クライアントあたりのパイプライン段数")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--tcp", action="store_true", help="Unixドメインソケットの代わりにTCP(127.0.0.1)を使う")
+    parser.add_argument("--port", type=int, default=7878)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = os.path.join(tmp, "nls.pkl")
+        start = time.perf_counter()
+        buildIndex(index, args.nodes, args.zlv, args.radius)
+        print("index: %d nodes built in %.2fs" % (args.nodes, time.perf_counter() - start))
+
+        cmd = [sys.executable, "-m", "VelLib.nl_server", "--pickle", index]
+        if args.tcp:
+            address = ("127.0.0.1", args.port)
+            cmd += ["--host", address[0], "--port", str(address[1])]
+        else:
+            address = os.path.join(tmp, "nl.sock")
+            cmd += ["--unix", address]
+        if args.workers:
+            cmd += ["--workers", str(args.workers)]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))), os.environ.get("PYTHONPATH")])))
+        server = subprocess.Popen(cmd, env=env)
+        try:
+            waitServer(address, server)
+            queue = Queue()
+            procs = [Process(target=client, args=(address, i, args.batch, args.depth, args.duration, queue)) for i in range(args.clients)]
+            start = time.perf_counter()
+            for p in procs:
+                p.start()
+            stats = [queue.get() for _ in procs]
+            elapsed = time.perf_counter() - start
+            for p in procs:
+                p.join()
+        finally:
+            server.terminate()
+            server.wait()
+
+    queries = sum(s[0] for s in stats)
+    latencies = sorted(l for s in stats for l in s[1])
+    print("transport: %s, clients: %d, batch: %d, depth: %d" % ("tcp" if args.tcp else "unix", args.clients, args.batch, args.depth))
+    print("queries: %d in %.2fs (%.0f queries/s, %.0f batches/s)" % (queries, elapsed, queries / elapsed, len(latencies) / elapsed))
+    p50, p90, p99 = (percentile(latencies, p) * 1000 for p in (0.5, 0.9, 0.99))
+    print("batch latency ms: p50 %.2f, p90 %.2f, p99 %.2f, max %.2f" % (p50, p90, p99, latencies[-1] * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""NLSystemのradius探索を総当たりと比較し、rowWindowの取りこぼしがないことを確認する。
+
+極付近と経度±180付近の地点を多めに含む。旧形式(radius導入前)のpickleを読み込んだ場合も確認する。
+取りこぼしがあれば終了コード1で終わる。
+
+実行例:
+    python benchmarks/nl_window_check.py
+    python benchmarks/nl_window_check.py --nodes 5000 --queries 1000
+"""
+import argparse
+import math
+import os
+import pickle
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from VelLib.nl_system import NLSystem
+
+# (zlv, radius[m])
+CASES = [
+    (3, 8000000), (3, 2000000), (5, 500000), (8, 300000), (8, 50000),
+    (10, 20000), (12, 20000), (12, 2000), (14, 500), (14, 50), (18, 500),
+]
+
+
+def randomNode(rnd, k):
+    if k % 3:
+        lat = rnd.uniform(-90, 90)
+    else:
+        lat = rnd.choice([1, -1]) * rnd.uniform(80, 90)
+    if k % 2:
+        lon = rnd.uniform(-180, 180)
+    else:
+        lon = rnd.choice([1, -1]) * rnd.uniform(179, 180)
+    return lat, lon
+
+
+def check(zlv, radius, nodes, queries, seed):
+    rnd = random.Random(seed)
+    nls = NLSystem(zlv, radius=radius)
+    pts = [randomNode(rnd, k) for k in range(nodes)]
+    for k, (lat, lon) in enumerate(pts):
+        nls.register(lat, lon, k)
+    # 緯度1度あたり約111km。ノードの周囲radius程度に問い合わせ点を散らす
+    spread = radius / 111000
+    misses = []
+    for q in range(queries):
+        lat, lon = pts[q % nodes]
+        lat = max(min(lat + rnd.uniform(-1, 1) * spread, 90.0), -90.0)
+        lon = (lon + rnd.uniform(-1, 1) * spread + 180.0) % 360.0 - 180.0
+        dist, key = min((nls.calculateDistance(lat, lon, *pts[k]), k) for k in range(nodes))
+        expected = key if dist <= radius else None
+        result = nls.nearestNodeSearch(lat, lon)
+        if result["name"] != expected:
+            misses.append((lat, lon, expected, dist, result))
+    return misses
+
+
+def oldDeg2num(n, lat, lon):
+    # radius導入前のdeg2num。xの折り返しもyのクランプもしない
+    lat_rad = math.radians(lat)
+    return int((lon + 180.0) / 360.0 * n), int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
+
+
+def checkOldPickle(zlv, radius, nodes, seed):
+    """旧形式のnlmapを持つpickleを読み込み、全ノードが自身の座標で見つかるか確認する"""
+    rnd = random.Random(seed)
+    pts = [randomNode(rnd, k) for k in range(nodes)]
+    # 旧deg2numは極で計算できないため緯度を少し内側にし、経度ちょうど180も含める
+    pts = [(max(min(lat, 89.9), -89.9), 180.0 if k % 7 == 0 else lon) for k, (lat, lon) in enumerate(pts)]
+    old = NLSystem.__new__(NLSystem)
+    old.__dict__.update({"sq": 2**zlv, "z": zlv, "nodes": {}, "nlmap": {}, "amin": -1, "amax": 2})
+    for k, (lat, lon) in enumerate(pts):
+        x, y = oldDeg2num(old.sq, lat, lon)
+        old.nlmap.setdefault(x, {}).setdefault(y, set()).add(k)
+        old.nodes[k] = (lat, lon)
+    nls = pickle.loads(pickle.dumps(old))
+    misses = []
+    for k, (lat, lon) in enumerate(pts):
+        for r in (None, radius):
+            result = nls.nearestNodeSearch(lat, lon, r)
+            if result["name"] is None or result["dist"] > 0.0:
+                misses.append((lat, lon, k, 0.0, result))
+    return misses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NLSystem rowWindow brute-force check")
+    parser.add_argument("--nodes", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    failed = False
+    for zlv, radius in CASES:
+        misses = check(zlv, radius, args.nodes, args.queries, args.seed)
+        print("zlv %2d radius %9.0fm: %d misses" % (zlv, radius, len(misses)))
+        for lat, lon, expected, dist, result in misses[:5]:
+            print("    query (%f, %f): expected %r (%.1fm), got %r" % (lat, lon, expected, dist, result))
+        failed = failed or bool(misses)
+    for zlv, radius in [(3, 2000000), (10, 20000), (18, 500)]:
+        misses = checkOldPickle(zlv, radius, args.nodes, args.seed)
+        print("old pickle zlv %2d radius %9.0fm: %d misses" % (zlv, radius, len(misses)))
+        for lat, lon, expected, dist, result in misses[:5]:
+            print("    query (%f, %f): expected %r (%.1fm), got %r" % (lat, lon, expected, dist, result))
+        failed = failed or bool(misses)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,5 +4,6 @@ setup(
     name='VelLib',
     version='0.3.6',
     packages=find_packages(),
-    install_requires=['requests']
+    install_requires=['requests'],
+    entry_points={'console_scripts': ['vel-nlserver=VelLib.nl_server:main']}
 )